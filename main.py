@@ -1,5 +1,6 @@
 import base64
-import json
+
+import orjson
 
 from models import Close
 
@@ -8,7 +9,7 @@ def main(request):
     request_json = request.get_json()
     message = request_json["message"]
     data_bytes = message["data"]
-    data = json.loads(base64.b64decode(data_bytes).decode("utf-8"))
+    data = orjson.loads(base64.b64decode(data_bytes))
     print(data)
 
     job = Close.factory(
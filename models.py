@@ -1,23 +1,85 @@
 import os
-import json
+import sys
+import gzip
+import base64
+import shutil
 import asyncio
+import tempfile
 from datetime import datetime
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABCMeta, abstractmethod
 
+import orjson
+import httpx
 import requests
-import aiohttp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.cloud import bigquery
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+if uvloop and not os.getenv("DISABLE_UVLOOP"):
+    uvloop.install()
+
 LIMIT = 100
+SPECULATE = 8
+CHUNK_SIZE = 10_000
+GZIP_LOAD_LIMIT = 4 * 1024 ** 3
 BASE_URL = "https://api.close.com/api/v1"
-AUTH = (os.getenv("AUTH_KEY"), "")
+AUTH_HEADER = {
+    "Authorization": "Basic "
+    + base64.b64encode(f"{os.getenv('AUTH_KEY')}:".encode()).decode()
+}
+
+CONCURRENCY = 32
+TIMEOUT = httpx.Timeout(60.0)
+LIMITS = httpx.Limits(
+    max_keepalive_connections=CONCURRENCY,
+    max_connections=CONCURRENCY,
+)
 
 BQ_CLIENT = bigquery.Client()
 DATASET = "Close"
 
-NOW = datetime.utcnow()
 DATE_FORMAT = "%Y-%m-%d"
 
+MAX_INCRE_CACHE = {}
+
+
+def to_schema_fields(schema):
+    return [
+        bigquery.SchemaField(
+            field["name"],
+            field["type"],
+            mode=field.get("mode", "NULLABLE"),
+            fields=to_schema_fields(field["fields"]) if field.get("fields") else (),
+        )
+        for field in schema
+    ]
+
+
+def compile_projector(required_keys, optional_keys):
+    entries = [f'"{key}": row["{key}"]' for key in required_keys]
+    entries += [f'"{key}": row.get("{key}")' for key in optional_keys]
+    return eval(f"lambda row: {{{', '.join(entries)}}}")
+
+
+def get_custom_fields(row):
+    dumps = orjson.dumps
+    intern = sys.intern
+    return [
+        {
+            "key": intern(key),
+            "value": dumps(value).decode("utf-8"),
+        }
+        for key, value in row.items()
+        if key.startswith("custom.cf")
+    ]
+
 
 def get_time_range(model):
     if model.start and model.end:
@@ -25,13 +87,21 @@ def get_time_range(model):
             datetime.strptime(i, DATE_FORMAT) for i in [model.start, model.end]
         ]
     else:
-        query = f"""
-        SELECT MAX({model.keys['incre_key']}) AS max_incre
-        FROM {DATASET}.{model.table}"""
-        result = BQ_CLIENT.query(query).result()
-        max_incre = [dict(i.items()) for i in result][0]["max_incre"]
+        max_incre = MAX_INCRE_CACHE.get(model.table)
+        if not max_incre:
+            query = f"""
+            SELECT MAX({model.keys['incre_key']}) AS max_incre
+            FROM {DATASET}.{model.table}"""
+            result = BQ_CLIENT.query(
+                query,
+                job_config=bigquery.QueryJobConfig(
+                    use_query_cache=True,
+                    priority=bigquery.QueryPriority.INTERACTIVE,
+                ),
+            ).result()
+            max_incre = next(iter(result))["max_incre"]
         start = max_incre
-        end = NOW
+        end = datetime.utcnow()
     return start, end
 
 
@@ -40,6 +110,46 @@ class Getter(metaclass=ABCMeta):
         self.endpoint = model.endpoint
         self.url = f"{BASE_URL}/{self.endpoint}/"
 
+    @staticmethod
+    def client():
+        return httpx.AsyncClient(
+            http2=True,
+            headers=AUTH_HEADER,
+            limits=LIMITS,
+            timeout=TIMEOUT,
+        )
+
+    @staticmethod
+    def session():
+        session = requests.Session()
+        session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_maxsize=16,
+                max_retries=Retry(
+                    total=5,
+                    backoff_factor=0.3,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=["GET"],
+                ),
+            ),
+        )
+        return session
+
+    @staticmethod
+    async def _loads(body):
+        return await asyncio.get_event_loop().run_in_executor(None, orjson.loads, body)
+
+    @staticmethod
+    def _run(coro):
+        loop = asyncio.new_event_loop()
+        if hasattr(asyncio, "eager_task_factory"):
+            loop.set_task_factory(asyncio.eager_task_factory)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
     @abstractmethod
     def get(self):
         pass
@@ -47,84 +157,94 @@ class Getter(metaclass=ABCMeta):
 
 class SimpleGetter(Getter):
     def get(self):
-        rows = []
+        return self._run(self._get_async())
+
+    async def _get_async(self):
+        async with self.client() as client:
+            rows = []
+            skip = 0
+            tasks = set()
+            has_more = True
+            while has_more or tasks:
+                while has_more and len(tasks) < SPECULATE:
+                    tasks.add(asyncio.create_task(self._get_page(client, skip)))
+                    skip += LIMIT
+                done, tasks = await asyncio.wait(
+                    tasks,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    page = task.result()
+                    rows.extend(page["data"])
+                    if not page.get("has_more"):
+                        has_more = False
+        return rows
+
+    async def _get_page(self, client, skip):
         params = {
             "_limit": LIMIT,
-            "_skip": 0,
+            "_skip": skip,
         }
-        with requests.Session() as session:
-            while True:
-                with session.get(self.url, params=params, auth=AUTH) as r:
-                    res = r.json()
-                rows.extend(res["data"])
-                has_more = res.get("has_more")
-                if has_more:
-                    params["_skip"] += LIMIT
-                else:
-                    break
-        return rows
+        r = await client.get(self.url, params=params)
+        return await self._loads(r.content)
 
 
 class IncreGetter(Getter):
     def __init__(self, model):
         super().__init__(model)
         self.start, self.end = get_time_range(model)
-        self._params_builder = model._params_builder
+        self._base_params = {
+            **model._params_builder(self.start, self.end),
+            "_limit": LIMIT,
+        }
 
     def _get_params(self, skip=0):
         return {
-            **self._params_builder(self.start, self.end),
-            "_limit": LIMIT,
+            **self._base_params,
             "_skip": skip,
         }
 
 
 class IncreAsyncGetter(IncreGetter):
     def get(self):
-        return asyncio.run(self._get_async())
+        return self._run(self._get_async())
 
     async def _get_async(self):
-        async with aiohttp.ClientSession() as session:
-            count = await self._get_count(session)
-            pages = [i for i in range(0, count, LIMIT)]
-            tasks = [asyncio.create_task(self._get_one(session, i)) for i in pages]
-            rows = await asyncio.gather(*tasks)
-        rows = [item for sublist in rows for item in sublist]
+        async with self.client() as client:
+            semaphore = asyncio.Semaphore(CONCURRENCY)
+            count = await self._get_count(client)
+            rows = []
+            for page in asyncio.as_completed(
+                [self._get_one(client, semaphore, i) for i in range(0, count, LIMIT)]
+            ):
+                rows.extend(await page)
         return rows
 
-    async def _get_count(self, session):
+    async def _get_count(self, client):
         params = self._get_params()
-        async with session.get(
-            self.url,
-            params=params,
-            auth=aiohttp.BasicAuth(*AUTH),
-        ) as r:
-            res = await r.json()
-        return res["total_results"]
-
-    async def _get_one(self, session, i):
+        r = await client.get(self.url, params=params)
+        return orjson.loads(r.content)["total_results"]
+
+    async def _get_one(self, client, semaphore, i):
         params = self._get_params(i)
-        async with session.get(
-            self.url,
-            params=params,
-            auth=aiohttp.BasicAuth(*AUTH),
-        ) as r:
-            res = await r.json()
+        async with semaphore:
+            r = await client.get(self.url, params=params)
+        res = await self._loads(r.content)
         return res["data"]
 
 
 class IncreSyncGetter(IncreGetter):
     def get(self):
-        params = self._params_builder(self.start, self.end)
+        params = self._get_params()
         rows = []
-        with requests.Session() as session:
+        with self.session() as session:
             while True:
                 with session.get(
                     self.url,
                     params=params,
-                    auth=AUTH,
+                    headers=AUTH_HEADER,
                 ) as r:
-                    res = r.json()
+                    res = orjson.loads(r.content)
                 rows.extend(res["data"])
                 has_more = res.get("has_more")
                 if has_more:
@@ -137,19 +257,10 @@ class IncreSyncGetter(IncreGetter):
 class Close(metaclass=ABCMeta):
     @staticmethod
     def factory(table, start, end):
-        args = (start, end)
-        if table == "Leads":
-            return Leads(*args)
-        elif table == "Opportunities":
-            return Opportunities(*args)
-        elif table == "CustomActivities":
-            return CustomActivities(*args)
-        elif table == "Users":
-            return Users(*args)
-        elif table == "CustomFields":
-            return CustomFields(*args)
-        else:
+        model = TABLES.get(table)
+        if not model:
             raise NotImplementedError(table)
+        return model(start, end)
 
     @property
     @abstractmethod
@@ -185,27 +296,48 @@ class Close(metaclass=ABCMeta):
         return rows
 
     def _load(self, rows):
-        return BQ_CLIENT.load_table_from_json(
-            rows,
+        it = iter(rows)
+        with ThreadPoolExecutor() as executor:
+            futures = []
+            while True:
+                chunk = list(islice(it, CHUNK_SIZE))
+                if not chunk:
+                    break
+                futures.append(executor.submit(self._load_chunk, self.transform(chunk)))
+            return sum(future.result().output_rows for future in futures)
+
+    def _load_chunk(self, rows):
+        buf = tempfile.SpooledTemporaryFile(mode="w+b")
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=1) as gz:
+            for row in rows:
+                gz.write(orjson.dumps(row) + b"\n")
+        if buf.tell() > GZIP_LOAD_LIMIT:
+            # BigQuery rejects gzipped JSON sources above 4 GB
+            raw = tempfile.SpooledTemporaryFile(mode="w+b")
+            buf.seek(0)
+            with gzip.GzipFile(fileobj=buf, mode="rb") as gz:
+                shutil.copyfileobj(gz, raw)
+            buf = raw
+        buf.seek(0)
+        return BQ_CLIENT.load_table_from_file(
+            buf,
             f"{DATASET}._stage_{self.table}",
             job_config=bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
                 create_disposition="CREATE_IF_NEEDED",
                 write_disposition="WRITE_APPEND",
-                schema=self.schema,
+                schema=self.schema_fields,
             ),
         ).result()
 
     def _update(self):
         query = f"""
         CREATE OR REPLACE TABLE {DATASET}.{self.table} AS
-        SELECT * EXCEPT (row_num) FROM
-        (
-            SELECT *,
-            ROW_NUMBER() OVER
-            (PARTITION BY {','.join(self.keys['p_key'])} ORDER BY {self.keys['incre_key']} DESC)
-            AS row_num
-            FROM {DATASET}._stage_{self.table}
-        ) WHERE row_num = 1"""
+        SELECT * FROM {DATASET}._stage_{self.table}
+        WHERE TRUE
+        QUALIFY ROW_NUMBER() OVER
+        (PARTITION BY {','.join(self.keys['p_key'])} ORDER BY {self.keys['incre_key']} DESC)
+        = 1"""
         BQ_CLIENT.query(query).result()
 
     def run(self):
@@ -218,10 +350,14 @@ class Close(metaclass=ABCMeta):
             response["start"] = self._getter.start.isoformat(timespec='seconds')
             response["end"] = self._getter.end.isoformat(timespec='seconds')
         if len(rows):
-            rows = self.transform(rows)
-            loads = self._load(rows)
-            self._update()
-            response["output_rows"] = loads.output_rows
+            output_rows = self._load(rows)
+            if output_rows:
+                self._update()
+                if not (self.start and self.end) and getattr(
+                    self._getter, "end", None
+                ):
+                    MAX_INCRE_CACHE[self.table] = self._getter.end
+            response["output_rows"] = output_rows
         return response
 
 
@@ -280,6 +416,7 @@ class Leads(Close):
             ],
         },
     ]
+    schema_fields = to_schema_fields(schema)
 
     @staticmethod
     def _params_builder(start, end):
@@ -288,59 +425,68 @@ class Leads(Close):
             "query": f"date_updated > {start} date_updated < {end}",
         }
 
+    @staticmethod
+    def _transform_phone(phone):
+        return {
+            "phone_formatted": phone.get("phone_formatted"),
+            "phone": phone.get("phone"),
+            "type": phone.get("type"),
+            "country": phone.get("country"),
+        }
+
+    @staticmethod
+    def _transform_email(email):
+        return {
+            "type": email.get("type"),
+            "email": email.get("email"),
+        }
+
+    @classmethod
+    def _transform_contact(cls, contact):
+        transform_phone = cls._transform_phone
+        transform_email = cls._transform_email
+        return {
+            "phones": [
+                transform_phone(phone) for phone in contact.get("phones") or ()
+            ],
+            "name": contact.get("name"),
+            "updated_by": contact.get("updated_by"),
+            "emails": [
+                transform_email(email) for email in contact.get("emails") or ()
+            ],
+            "date_updated": contact.get("date_updated"),
+            "display_name": contact.get("display_name"),
+            "date_created": contact.get("date_created"),
+            "lead_id": contact.get("lead_id"),
+            "created_by": contact.get("created_by"),
+            "title": contact.get("title"),
+            "id": contact.get("id"),
+        }
+
+    _project = staticmethod(
+        compile_projector(
+            ("id", "date_updated"),
+            (
+                "display_name",
+                "updated_by",
+                "status_id",
+                "created_by",
+                "custom_lead_owner",
+                "organization_id",
+                "date_created",
+            ),
+        )
+    )
+
     def transform(self, rows):
-        rows = [
-            {
-                "id": row["id"],
-                "date_updated": row["date_updated"],
-                "display_name": row.get("display_name"),
-                "updated_by": row.get("updated_by"),
-                "status_id": row.get("status_id"),
-                "created_by": row.get("created_by"),
-                "custom_lead_owner": row.get("custom_lead_owner"),
-                "organization_id": row.get("organization_id"),
-                "date_created": row.get("date_created"),
-                #
-                "contacts": [
-                    {
-                        "phones": [
-                            {
-                                "phone_formatted": phone.get("phone_formatted"),
-                                "phone": phone.get("phone"),
-                                "type": phone.get("type"),
-                                "country": phone.get("country"),
-                            }
-                            for phone in contact.get("phones")
-                        ]
-                        if contact.get("phones")
-                        else [],
-                        "name": contact.get("name"),
-                        "updated_by": contact.get("updated_by"),
-                        "emails": [
-                            {
-                                "type": email.get("type"),
-                                "email": email.get("email"),
-                            }
-                            for email in contact.get("emails")
-                        ]
-                        if contact.get("emails")
-                        else [],
-                        "date_updated": contact.get("date_updated"),
-                        "display_name": contact.get("display_name"),
-                        "date_created": contact.get("date_created"),
-                        "lead_id": contact.get("lead_id"),
-                        "created_by": contact.get("created_by"),
-                        "title": contact.get("title"),
-                        "id": contact.get("id"),
-                    }
-                    for contact in row.get("contacts")
-                ]
-                if row.get("contacts")
-                else [],
-            }
-            for row in rows
-        ]
-        return rows
+        project = self._project
+        transform_contact = self._transform_contact
+        for row in rows:
+            record = project(row)
+            record["contacts"] = [
+                transform_contact(contact) for contact in row.get("contacts") or ()
+            ]
+            yield record
 
 
 class CustomActivities(Close):
@@ -370,6 +516,7 @@ class CustomActivities(Close):
             ],
         },
     ]
+    schema_fields = to_schema_fields(schema)
 
     @staticmethod
     def _params_builder(start, end):
@@ -379,7 +526,7 @@ class CustomActivities(Close):
         }
 
     def transform(self, rows):
-        return [
+        return (
             {
                 "id": row["id"],
                 "date_created": row["date_created"],
@@ -389,17 +536,10 @@ class CustomActivities(Close):
                 "custom_activity_type_id": row.get("custom_activity_type_id"),
                 "_type": row.get("_type"),
                 "status": row.get("status"),
-                "custom_fields": [
-                    {
-                        "key": key,
-                        "value": json.dumps(value),
-                    }
-                    for key, value in row.items()
-                    if "custom.cf" in key
-                ],
+                "custom_fields": get_custom_fields(row),
             }
             for row in rows
-        ]
+        )
 
 
 class Opportunities(Close):
@@ -449,6 +589,7 @@ class Opportunities(Close):
             ],
         },
     ]
+    schema_fields = to_schema_fields(schema)
 
     @staticmethod
     def _params_builder(start, end):
@@ -457,49 +598,49 @@ class Opportunities(Close):
             "date_updated__lte": end.strftime(DATE_FORMAT),
         }
 
+    _project = staticmethod(
+        compile_projector(
+            ("id", "date_updated"),
+            (
+                "updated_by",
+                "created_by",
+                "organization_id",
+                "contact_name",
+                "lead_id",
+                "expected_value",
+                "status_display_name",
+                "date_created",
+                "annualized_value",
+                "status_id",
+                "status_type",
+                "value",
+                "value_currency",
+                "note",
+                "value_period",
+                "status_label",
+                "lead_name",
+                "created_by_name",
+                "updated_by_name",
+                "user_name",
+                "annualized_expected_value",
+                "value_formatted",
+                "user_id",
+                "contact_id",
+                "date_won",
+                "date_lost",
+            ),
+        )
+    )
+
     def transform(self, rows):
-        return [
+        project = self._project
+        return (
             {
-                "id": row["id"],
-                "date_updated": row["date_updated"],
-                "updated_by": row.get("updated_by"),
-                "created_by": row.get("created_by"),
-                "organization_id": row.get("organization_id"),
-                "contact_name": row.get("contact_name"),
-                "lead_id": row.get("lead_id"),
-                "expected_value": row.get("expected_value"),
-                "status_display_name": row.get("status_display_name"),
-                "date_created": row.get("date_created"),
-                "annualized_value": row.get("annualized_value"),
-                "status_id": row.get("status_id"),
-                "status_type": row.get("status_type"),
-                "value": row.get("value"),
-                "value_currency": row.get("value_currency"),
-                "note": row.get("note"),
-                "value_period": row.get("value_period"),
-                "status_label": row.get("status_label"),
-                "lead_name": row.get("lead_name"),
-                "created_by_name": row.get("created_by_name"),
-                "updated_by_name": row.get("updated_by_name"),
-                "user_name": row.get("user_name"),
-                "annualized_expected_value": row.get("annualized_expected_value"),
-                "annualized_value": row.get("annualized_value"),
-                "value_formatted": row.get("value_formatted"),
-                "user_id": row.get("user_id"),
-                "contact_id": row.get("contact_id"),
-                "date_won": row.get("date_won"),
-                "date_lost": row.get("date_lost"),
-                "custom_fields": [
-                    {
-                        "key": key,
-                        "value": json.dumps(value),
-                    }
-                    for key, value in row.items()
-                    if "custom.cf" in key
-                ],
+                **project(row),
+                "custom_fields": get_custom_fields(row),
             }
             for row in rows
-        ]
+        )
 
 
 class Users(Close):
@@ -521,22 +662,28 @@ class Users(Close):
         {"name": "date_created", "type": "TIMESTAMP"},
         {"name": "image", "type": "STRING"},
     ]
+    schema_fields = to_schema_fields(schema)
+
+    _project = staticmethod(
+        compile_projector(
+            (),
+            (
+                "email",
+                "id",
+                "first_name",
+                "last_name",
+                "date_updated",
+                "last_used_timezone",
+                "email_verified_at",
+                "date_created",
+                "image",
+            ),
+        )
+    )
 
     def transform(self, rows):
-        return [
-            {
-                "email": row.get("email"),
-                "id": row.get("id"),
-                "first_name": row.get("first_name"),
-                "last_name": row.get("last_name"),
-                "date_updated": row.get("date_updated"),
-                "last_used_timezone": row.get("last_used_timezone"),
-                "email_verified_at": row.get("email_verified_at"),
-                "date_created": row.get("date_created"),
-                "image": row.get("image"),
-            }
-            for row in rows
-        ]
+        project = self._project
+        return (project(row) for row in rows)
 
 
 class CustomFields(Close):
@@ -569,9 +716,10 @@ class CustomFields(Close):
             ],
         },
     ]
+    schema_fields = to_schema_fields(schema)
 
     def transform(self, rows):
-        return [
+        return (
             {
                 "id": row["id"],
                 "name": row["name"],
@@ -593,4 +741,16 @@ class CustomFields(Close):
                 ],
             }
             for row in rows
-        ]
+        )
+
+
+TABLES = {
+    model.table: model
+    for model in [
+        Leads,
+        Opportunities,
+        CustomActivities,
+        Users,
+        CustomFields,
+    ]
+}